@@ -1,11 +1,45 @@
 ﻿import asyncio
+import itertools
 import os
-import subprocess
 import logging
 import datetime
+import mmap
+import threading
+import time
+
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    import json
+    def _json_loads(data):
+        # stdlib json can't take buffer objects like mmap directly
+        if not isinstance(data, (str, bytes, bytearray)):
+            data = bytes(data)
+        return json.loads(data)
+
+try:
+    import ciso8601
+    _parse_datetime = ciso8601.parse_datetime
+except ImportError:
+    def _parse_datetime(value):
+        return datetime.datetime.fromisoformat(value.replace('Z', '+00:00'))
+
 from fastapi import FastAPI, Request, BackgroundTasks
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi.concurrency import run_in_threadpool
+from email.utils import formatdate
+
+from fastapi.responses import FileResponse, HTMLResponse, JSONResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.middleware.gzip import GZipMiddleware
+from jinja2 import Environment, FileSystemLoader, select_autoescape
+from markupsafe import Markup
+
+try:
+    import uvloop
+    uvloop.install()
+except ImportError:
+    pass
 
 logging.basicConfig(level=logging.INFO)
 app = FastAPI()
@@ -18,46 +52,159 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# The rendered page is mostly repetitive markup; gzip cuts it to a fraction
+app.add_middleware(GZipMiddleware, minimum_size=1024)
+
 # Configuration
 LOCAL_CODES_PATH = "docs/codes.json"
+TEMPLATE_DIR = "templates"
 UPDATE_INTERVAL = 3600  # 1 hour in seconds
+SCRAPER_DEBOUNCE = 60  # minimum seconds between scraper runs
+
+# Compile the index template once at import; the static CSS/JS blocks
+# become constant chunks in the compiled template, never re-parsed per
+# request. Autoescape handles HTML escaping of code/reward/source fields.
+_jinja_env = Environment(
+    loader=FileSystemLoader(TEMPLATE_DIR),
+    autoescape=select_autoescape(["html"]),
+)
+_index_template = _jinja_env.get_template("index.html")
 
-def run_scraper() -> bool:
+# Only one scraper subprocess at a time: the periodic task and /api/update
+# can both fire, and each npm run is expensive. The debounce also stops a
+# spam-clicked refresh button from queueing back-to-back runs.
+_scraper_lock = threading.Lock()
+_scraper_last_run = 0.0
+
+def _scraper_debounced() -> bool:
+    """True if a scraper run started less than SCRAPER_DEBOUNCE seconds ago"""
+    return time.monotonic() - _scraper_last_run < SCRAPER_DEBOUNCE
+
+async def run_scraper() -> bool:
     """Run the Node.js scraper to update codes"""
+    global _scraper_last_run
+    if not _scraper_lock.acquire(blocking=False):
+        logging.info("Scraper already running, skipping")
+        return False
     try:
+        if _scraper_debounced():
+            logging.info("Scraper ran recently, skipping")
+            return False
+        _scraper_last_run = time.monotonic()
         logging.info("Running code scraper...")
-        result = subprocess.run(
-            ["npm", "run", "build"], 
+        proc = await asyncio.create_subprocess_exec(
+            "npm", "run", "build",
             cwd=".",
-            capture_output=True, 
-            text=True,
-            timeout=180
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
         )
-        if result.returncode == 0:
+        try:
+            stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout=180)
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+            logging.error("Scraper timed out after 3 minutes")
+            return False
+        if proc.returncode == 0:
             logging.info("Scraper completed successfully")
-            logging.info(f"Scraper output: {result.stdout}")
+            logging.info(f"Scraper output: {stdout.decode()}")
             return True
         else:
-            logging.error(f"Scraper failed: {result.stderr}")
+            logging.error(f"Scraper failed: {stderr.decode()}")
             return False
-    except subprocess.TimeoutExpired:
-        logging.error("Scraper timed out after 3 minutes")
-        return False
     except Exception as e:
         logging.error(f"Failed to run scraper: {e}")
         return False
+    finally:
+        _scraper_lock.release()
+
+# In-process cache keyed on the codes file's mtime. The file only changes
+# when the scraper rewrites it (hourly), so between runs every request can
+# reuse the parsed dict and the active/expired buckets without touching disk.
+_cache_lock = threading.Lock()
+_cache_mtime = None
+_cache_parsed = None
+_cache_buckets = None
+_cache_rendered = None
+
+def _codes_mtime():
+    """mtime (ns) of the local codes file, or None if it doesn't exist"""
+    try:
+        return os.stat(LOCAL_CODES_PATH).st_mtime_ns
+    except OSError:
+        return None
 
 def load_local_codes():
-    """Load codes from local file"""
+    """Load codes from local file, cached until the file changes"""
+    global _cache_mtime, _cache_parsed, _cache_buckets, _cache_rendered
+    mtime = _codes_mtime()
+    with _cache_lock:
+        if mtime is not None and mtime == _cache_mtime:
+            return _cache_parsed
+        parsed = _enrich_codes(_read_local_codes())
+        _cache_mtime = mtime
+        _cache_parsed = parsed
+        _cache_buckets = None
+        _cache_rendered = None
+        return parsed
+
+# Single C-level pass over the string, vs. html.escape's chained replaces.
+# Escaped values are wrapped in Markup so the template's autoescape doesn't
+# escape them a second time.
+_ESC = str.maketrans({'&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', "'": '&#39;'})
+
+def _escape(value):
+    """HTML-escape a field value; non-strings become empty Markup"""
+    return Markup(value.translate(_ESC)) if isinstance(value, str) else Markup('')
+
+def _enrich_codes(parsed):
+    """Parse each code's expires timestamp once and attach display fields"""
+    if not parsed:
+        return parsed
+    for code in parsed.get("codes", []):
+        exp_str = code.get("expires")
+        exp_dt = None
+        if exp_str:
+            try:
+                exp_dt = _parse_datetime(exp_str)
+            except ValueError:
+                logging.warning("Unparseable expires value: %s", exp_str)
+        code["_expires_dt"] = exp_dt
+        if exp_dt is not None:
+            # ~3x faster than strftime for a fixed simple pattern
+            code["_expires_display"] = Markup(f"{exp_dt.month:02d}/{exp_dt.day:02d}/{exp_dt.year}")
+        else:
+            code["_expires_display"] = _escape(exp_str) or "Permanent"
+        # Pre-escape everything the template interpolates so the render
+        # loop does zero escaping work
+        code["_code_html"] = _escape(code.get("code"))
+        code["_reward_html"] = _escape(code.get("reward"))
+        code["_source_html"] = _escape(code.get("source"))
+    return parsed
+
+# Below this size mmap setup overhead dominates and a plain read is faster
+_MMAP_MIN_SIZE = 64 * 1024
+
+def _read_local_codes():
+    """Read and parse codes from disk (uncached)"""
     try:
         if os.path.exists(LOCAL_CODES_PATH):
-            with open(LOCAL_CODES_PATH, 'r', encoding='utf-8') as f:
-                data = f.read()
-                if not data.strip():
+            with open(LOCAL_CODES_PATH, 'rb') as f:
+                size = os.fstat(f.fileno()).st_size
+                if size == 0:
                     logging.warning("Local codes file is empty")
                     return None
-                import json
-                parsed = json.loads(data)
+                if size >= _MMAP_MIN_SIZE:
+                    # Parse straight out of the page cache, no bytes copy;
+                    # orjson takes buffer objects via memoryview
+                    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                    try:
+                        with memoryview(mm) as view:
+                            parsed = _json_loads(view)
+                    finally:
+                        mm.close()
+                else:
+                    parsed = _json_loads(f.read())
                 logging.info(f"Loaded {len(parsed.get('codes', []))} codes from local file")
                 return parsed
         else:
@@ -66,39 +213,35 @@ def load_local_codes():
         logging.error(f"Failed to load local codes: {e}")
     return None
 
-def fetch_codes():
-    """Fetch codes from local file"""
-    data = load_local_codes()
-    
+def fetch_codes(data):
+    """Bucket already-parsed codes data into active and expired"""
+    global _cache_buckets
+
     if not data:
         return {"active": [], "expired": [], "error": "No codes available"}
-    
+
+    with _cache_lock:
+        if _cache_buckets is not None:
+            return _cache_buckets
+
     # Process codes with more aggressive expiration logic
     codes = data.get("codes", [])
     now = datetime.datetime.now(datetime.timezone.utc)
-    active, expired = [], []
-    
-    for code in codes:
-        exp_str = code.get("expires")
-        is_expired = False
-        
-        if exp_str:
-            try:
-                expires = datetime.datetime.fromisoformat(exp_str)
-                # More aggressive: if expires today, consider it expired
-                if expires <= now:
-                    is_expired = True
-            except ValueError:
-                # If date parsing fails, check if it looks like a past date
-                if any(month in exp_str.lower() for month in ['sep', 'september']) and '26' in exp_str:
-                    is_expired = True
-        
-        if is_expired:
-            expired.append(code)
-        else:
-            active.append(code)
-    
-    return {"active": active, "expired": expired}
+
+    def _is_expired(code):
+        # More aggressive: if expires today, consider it expired.
+        # Unparseable dates were logged at load time and count as active.
+        expires = code.get("_expires_dt")
+        return expires is not None and expires <= now
+
+    flags = [_is_expired(code) for code in codes]
+    active = list(itertools.compress(codes, (not f for f in flags)))
+    expired = list(itertools.compress(codes, flags))
+
+    buckets = {"active": active, "expired": expired}
+    with _cache_lock:
+        _cache_buckets = buckets
+    return buckets
 
 async def periodic_update():
     """Background task to update codes every hour"""
@@ -107,7 +250,7 @@ async def periodic_update():
     while True:
         try:
             logging.info("Running periodic code update...")
-            success = run_scraper()
+            success = await run_scraper()
             if success:
                 logging.info("Periodic update completed successfully")
             else:
@@ -124,242 +267,82 @@ async def startup_event():
     logging.info("Starting background update task...")
     asyncio.create_task(periodic_update())
 
-@app.get("/", response_class=HTMLResponse)
-def index(request: Request):
-    codes = fetch_codes()
-    
+def _render(local_data) -> bytes:
+    """Build the full index page for the given parsed codes data"""
+    codes = fetch_codes(local_data)
+
     last_updated = "Unknown"
-    local_data = load_local_codes()
     if local_data and "updated" in local_data:
         try:
-            updated_time = datetime.datetime.fromisoformat(local_data["updated"].replace('Z', '+00:00'))
+            updated_time = _parse_datetime(local_data["updated"])
             last_updated = updated_time.strftime("%Y-%m-%d %H:%M:%S UTC")
         except:
             pass
-    
-    html = f"""
-<!DOCTYPE html>
-<html>
-<head>
-    <title>Borderlands 4 SHiFT Codes</title>
-    <meta charset="utf-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1">
-    <style>
-        body {{ font-family: Arial, sans-serif; margin: 20px; background: #1a1a1a; color: #fff; }}
-        .header {{ background: #2d2d2d; padding: 20px; border-radius: 8px; margin-bottom: 20px; }}
-        .status {{ display: flex; gap: 20px; margin: 10px 0; flex-wrap: wrap; }}
-        .section {{ background: #2d2d2d; padding: 15px; border-radius: 8px; margin-bottom: 20px; }}
-        .guide-section {{ background: linear-gradient(135deg, #4CAF50, #45a049); padding: 20px; border-radius: 8px; margin-bottom: 20px; text-align: center; }}
-        .guide-link {{ color: white; text-decoration: none; font-size: 18px; font-weight: bold; display: inline-flex; align-items: center; gap: 10px; }}
-        .guide-link:hover {{ text-decoration: underline; }}
-        .guide-description {{ margin-top: 10px; font-size: 14px; opacity: 0.9; }}
-        table {{ width: 100%; border-collapse: collapse; }}
-        th, td {{ padding: 10px; text-align: left; border-bottom: 1px solid #444; }}
-        th {{ background: #3d3d3d; }}
-        .code {{ font-family: monospace; background: #444; padding: 4px 8px; border-radius: 4px; }}
-        .active {{ border-left: 4px solid #4CAF50; }}
-        .refresh-btn {{ background: #4CAF50; color: white; border: none; padding: 10px 20px; border-radius: 4px; cursor: pointer; }}
-        .refresh-btn:hover {{ background: #45a049; }}
-        .refresh-btn:disabled {{ background: #666; cursor: not-allowed; }}
-        .copy-btn {{ background: #2196F3; color: white; border: none; padding: 4px 8px; border-radius: 3px; cursor: pointer; font-size: 12px; }}
-        .copy-btn:hover {{ background: #1976D2; }}
-        .copy-btn:disabled {{ background: #666; }}
-        .checkbox {{ margin-right: 8px; }}
-        .redeemed {{ opacity: 0.5; text-decoration: line-through; }}
-        a {{ color: #64B5F6; }}
-        .update-info {{ font-size: 14px; color: #aaa; margin-top: 10px; }}
-        .code-actions {{ display: flex; gap: 8px; align-items: center; }}
-        @media (max-width: 768px) {{ 
-            .status {{ flex-direction: column; gap: 10px; }} 
-            .guide-link {{ font-size: 16px; }}
-        }}
-    </style>
-</head>
-<body>
-    <div class="header">
-        <h1>🎮 Borderlands 4 SHiFT Codes</h1>
-        <div class="status">
-            <div><strong>Last Updated:</strong> {last_updated}</div>
-            <div><strong>Active Codes:</strong> {len(codes['active'])}</div>
-        </div>
-        <button class="refresh-btn" onclick="updateCodes()">🔄 Force Update</button>
-        <div class="update-info">Updates automatically every hour</div>
-    </div>
-
-    <div class="guide-section">
-        <a href="https://docs.google.com/spreadsheets/d/1bw4-jnEBbwCa3EnJ9cp8HW839ymgzbbHKIGRo9wgNyo/htmlview?usp=drivesdk" target="_blank" class="guide-link">
-            🗡️ Borderlands 4 Legendary Farming Guide
-        </a>
-        <div class="guide-description">Complete spreadsheet with legendary locations, drops, and farming tips</div>
-    </div>
-
-    <div class="section active">
-        <h2>🟢 Active Codes ({len(codes['active'])})</h2>
-        <table>
-            <tr><th>✓</th><th>Code</th><th>Reward</th><th>Expires</th><th>Actions</th><th>Source</th></tr>
-"""
-    
-    for row in codes['active']:
-        code = row['code']
-        expires = row.get('expires', 'Permanent')
-        if expires and expires != 'Permanent':
-            try:
-                exp_time = datetime.datetime.fromisoformat(expires.replace('Z', '+00:00'))
-                expires_display = exp_time.strftime("%m/%d/%Y")
-            except:
-                expires_display = expires
-        else:
-            expires_display = "Permanent"
-        
-        source_link = f"<a href='{row['source']}' target='_blank'>Source</a>" if row.get('source') else "—"
-        html += f"""
-            <tr id="code-{code}" class="code-row">
-                <td>
-                    <input type="checkbox" class="checkbox" id="check-{code}" onchange="toggleRedeemed('{code}')">
-                </td>
-                <td><span class="code">{code}</span></td>
-                <td>{row.get('reward', '—')}</td>
-                <td>{expires_display}</td>
-                <td>
-                    <div class="code-actions">
-                        <button class="copy-btn" onclick="copyCode('{code}')">📋 Copy</button>
-                    </div>
-                </td>
-                <td>{source_link}</td>
-            </tr>
-        """
-    
-    html += """
-        </table>
-    </div>
-
-    <script>
-        // Load redeemed codes from localStorage
-        function loadRedeemedCodes() {
-            const redeemed = JSON.parse(localStorage.getItem('redeemedCodes') || '[]');
-            redeemed.forEach(code => {
-                const checkbox = document.getElementById(`check-${code}`);
-                const row = document.getElementById(`code-${code}`);
-                if (checkbox && row) {
-                    checkbox.checked = true;
-                    row.classList.add('redeemed');
-                }
-            });
-        }
-
-        // Toggle redeemed status
-        function toggleRedeemed(code) {
-            const checkbox = document.getElementById(`check-${code}`);
-            const row = document.getElementById(`code-${code}`);
-            const redeemed = JSON.parse(localStorage.getItem('redeemedCodes') || '[]');
-            
-            if (checkbox.checked) {
-                row.classList.add('redeemed');
-                if (!redeemed.includes(code)) {
-                    redeemed.push(code);
-                }
-            } else {
-                row.classList.remove('redeemed');
-                const index = redeemed.indexOf(code);
-                if (index > -1) {
-                    redeemed.splice(index, 1);
-                }
-            }
-            
-            localStorage.setItem('redeemedCodes', JSON.stringify(redeemed));
-        }
-
-        // Copy code to clipboard
-        async function copyCode(code) {
-            try {
-                await navigator.clipboard.writeText(code);
-                // Visual feedback
-                const btn = event.target;
-                const originalText = btn.textContent;
-                btn.textContent = '✅ Copied!';
-                btn.disabled = true;
-                
-                setTimeout(() => {
-                    btn.textContent = originalText;
-                    btn.disabled = false;
-                }, 2000);
-            } catch (err) {
-                // Fallback for older browsers
-                const textArea = document.createElement('textarea');
-                textArea.value = code;
-                document.body.appendChild(textArea);
-                textArea.select();
-                document.execCommand('copy');
-                document.body.removeChild(textArea);
-                
-                const btn = event.target;
-                const originalText = btn.textContent;
-                btn.textContent = '✅ Copied!';
-                setTimeout(() => {
-                    btn.textContent = originalText;
-                }, 2000);
-            }
-        }
-
-        // Force update
-        async function updateCodes() {
-            const btn = document.querySelector('.refresh-btn');
-            btn.textContent = '⏳ Updating...';
-            btn.disabled = true;
-            
-            try {
-                const response = await fetch('/api/update', { method: 'POST' });
-                
-                if (response.ok) {
-                    setTimeout(() => location.reload(), 3000);
-                    btn.textContent = '✅ Update triggered, reloading...';
-                } else {
-                    btn.textContent = '❌ Update failed';
-                    setTimeout(() => {
-                        btn.textContent = '🔄 Force Update';
-                        btn.disabled = false;
-                    }, 3000);
-                }
-            } catch (error) {
-                btn.textContent = '❌ Network error';
-                setTimeout(() => {
-                    btn.textContent = '🔄 Force Update';
-                    btn.disabled = false;
-                }, 3000);
-            }
-        }
-
-        // Load redeemed codes on page load
-        document.addEventListener('DOMContentLoaded', loadRedeemedCodes);
-    </script>
-</body>
-</html>
-    """
-    
-    return html
+
+    html = _index_template.render(active=codes['active'], last_updated=last_updated)
+    return html.encode("utf-8")
+
+@app.get("/", response_class=HTMLResponse)
+async def index(request: Request):
+    global _cache_rendered
+    local_data = await run_in_threadpool(load_local_codes)
+    with _cache_lock:
+        mtime = _cache_mtime
+        rendered = _cache_rendered
+
+    # The page only changes when codes.json does, so its mtime doubles as
+    # a validator: repeat visitors get a bodyless 304
+    headers = {}
+    if mtime is not None:
+        etag = f'W/"{mtime}"'
+        headers["ETag"] = etag
+        headers["Last-Modified"] = formatdate(mtime / 1e9, usegmt=True)
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=304, headers=headers)
+
+    if rendered is None:
+        rendered = _render(local_data)
+        with _cache_lock:
+            _cache_rendered = rendered
+    return HTMLResponse(content=rendered, headers=headers)
 
 @app.get("/api/codes")
 def api_codes():
     """API endpoint to get raw codes data"""
-    data = load_local_codes()
-    if data:
-        return data
-    return {"error": "No codes available", "codes": []}
+    # Pass the file through untouched — no parse/re-serialize round trip,
+    # and none of the private _-prefixed fields the enrichment pass adds
+    if os.path.exists(LOCAL_CODES_PATH):
+        return FileResponse(LOCAL_CODES_PATH, media_type="application/json")
+    return JSONResponse({"error": "No codes available", "codes": []}, status_code=503)
 
 @app.post("/api/update")
 def manual_update(background_tasks: BackgroundTasks):
     """Manual trigger for code update"""
-    def update_task():
-        success = run_scraper()
+    if _scraper_lock.locked() or _scraper_debounced():
+        return JSONResponse(
+            {"message": "Update already running or ran recently"},
+            status_code=429,
+        )
+
+    async def update_task():
+        success = await run_scraper()
         logging.info(f"Manual update {'succeeded' if success else 'failed'}")
     
     background_tasks.add_task(update_task)
     return {"message": "Update triggered"}
 
+# Liveness probes poll /api/status constantly; re-stat at most every 5s
+EXISTS_TTL = 5
+_exists_cache = (0.0, False)
+
 @app.get("/api/status")
 def status():
     """Get system status"""
+    global _exists_cache
+    now = time.monotonic()
+    if now - _exists_cache[0] > EXISTS_TTL:
+        _exists_cache = (now, os.path.exists(LOCAL_CODES_PATH))
     return {
-        "local_file_exists": os.path.exists(LOCAL_CODES_PATH),
+        "local_file_exists": _exists_cache[1],
         "update_interval": UPDATE_INTERVAL
     }
\ No newline at end of file